@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 from .transport import (
+    BatchQueue,
     get_transport,
     Transport,
 )
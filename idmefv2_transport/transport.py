@@ -2,18 +2,51 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import abc
-import pkg_resources
+import threading
+import time
 import warnings
 
 from collections.abc import Callable
 from idmefv2 import Message
-from queue import Queue
+from queue import Full, Queue
 from typing import Optional
 
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    from importlib_metadata import entry_points
+
 _transports = None
+_transports_lock = threading.Lock()
+
+
+def _make_validator(allowed_types, cast_to, min=None, max=None):
+    """
+    Returns a function that validates a value for a parameter
+    with the given settings, and returns the value cast to
+    the appropriate type.
+    """
+    def validator(value):
+        if not isinstance(value, allowed_types):
+            raise ValueError(value)
+
+        value = cast_to(value)
+        if (min is not None and value < min) or \
+           (max is not None and value > max):
+            raise ValueError(value)
+        return value
+    return validator
 
 
 class Transport(metaclass=abc.ABCMeta):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Build the validators for the parameters once and for all.
+        cls._validators = {
+            name: _make_validator(**conf)
+            for name, conf in getattr(cls, 'parameters', {}).items()
+        }
+
     @abc.abstractmethod
     def __init__(self, url: str, queue: Optional[Queue] = None, content_type: Optional[str] = None) -> None:
         """
@@ -142,6 +175,69 @@ class Transport(metaclass=abc.ABCMeta):
         raise NotImplementedError()
 
 
+class BatchQueue(Queue):
+    """
+    A queue that can receive several items at once.
+
+    Transports which receive IDMEFv2 messages in batches add them
+    to such a queue with a single lock acquisition, instead of
+    one per message, and either all of them are added or none are.
+    """
+    def put_many(self, items, block: bool = True, timeout: Optional[float] = None) -> None:
+        """
+        Puts several items into the queue, in order.
+
+        The block and timeout arguments have the same meaning as for put(),
+        except that the queue must have room for all the items at once.
+        If the queue.Full exception is raised (including when the queue's
+        maxsize is smaller than the number of items), no item is added.
+        """
+        items = list(items)
+        nb_items = len(items)
+        with self.not_full:
+            if self.maxsize > 0:
+                if nb_items > self.maxsize:
+                    raise Full
+                if not block:
+                    if self.maxsize - self._qsize() < nb_items:
+                        raise Full
+                elif timeout is None:
+                    while self.maxsize - self._qsize() < nb_items:
+                        self.not_full.wait()
+                elif timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                else:
+                    endtime = time.monotonic() + timeout
+                    while self.maxsize - self._qsize() < nb_items:
+                        remaining = endtime - time.monotonic()
+                        if remaining <= 0.0:
+                            raise Full
+                        self.not_full.wait(remaining)
+
+            for item in items:
+                self._put(item)
+            self.unfinished_tasks += nb_items
+            self.not_empty.notify(nb_items)
+
+
+def put_many(queue: Queue, items, timeout: Optional[float] = None) -> None:
+    """
+    Puts several items into the given queue, in order.
+
+    This uses the queue's put_many() method (see {BatchQueue}) when
+    available, in which case either all the items are added or none are.
+    Otherwise, it falls back to putting the items one by one, and some
+    of them may already have been added when queue.Full is raised.
+    """
+    method = getattr(queue, 'put_many', None)
+    if method is not None:
+        method(items, timeout=timeout)
+        return
+
+    for item in items:
+        queue.put(item, timeout=timeout)
+
+
 def get_transport(url: str, queue: Optional[Queue] = None, content_type: Optional[str] = None) -> Transport:
     """
     This methods returns a transport layer compatible with the
@@ -163,13 +259,27 @@ def get_transport(url: str, queue: Optional[Queue] = None, content_type: Optiona
     global _transports
 
     if _transports is None:
-        _transports = {}
-        for entry_point in pkg_resources.iter_entry_points('idmefv2.transport'):
-            try:
-                cls = entry_point.load()
-                if issubclass(cls, Transport):
-                    _transports[entry_point.name] = cls
-            except Exception as e:
-                warnings.warn(str(e), ResourceWarning)
+        with _transports_lock:
+            if _transports is None:
+                _transports = _load_transports()
 
     return _transports[url.partition('://')[0]](url, queue, content_type)
+
+
+def _load_transports() -> dict:
+    transports = {}
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group='idmefv2.transport')
+    else:
+        # Python < 3.10 returns a dict of entry points, indexed by group.
+        eps = eps.get('idmefv2.transport', ())
+
+    for entry_point in eps:
+        try:
+            cls = entry_point.load()
+            if issubclass(cls, Transport):
+                transports[entry_point.name] = cls
+        except Exception as e:
+            warnings.warn(str(e), ResourceWarning)
+    return transports
@@ -2,8 +2,10 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import fcntl
+import itertools
 import mimetypes
 import os
+import select
 import threading
 import time
 import warnings
@@ -16,6 +18,11 @@ from urllib.parse import urlparse, unquote
 from ..exceptions import InvalidLocationError
 from ..transport import Transport
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 O_BINARY = getattr(os, 'O_BINARY', 0)
 O_CREAT = getattr(os, 'O_CREAT', 0)
 O_EXCL = getattr(os, 'O_EXCL', 0)
@@ -48,14 +55,18 @@ class FileTransport(Transport):
         if content_type:
             self.content_type = content_type
 
-        # Check whether the given content_type is supported.
-        get_serializer(self.content_type)
+        # Check whether the given content_type is supported,
+        # and keep the matching serializer around for later use.
+        self.serializer = get_serializer(self.content_type)
 
         # Private parameters.
         self.path = path
+        self.extension = mimetypes.guess_extension(self.content_type) or ''
+        self.counter = itertools.count()
         self.lock = threading.Lock()
         self.checker = None
         self.checker_shutdown = threading.Event()
+        self.checker_wakeup = None
         self.queue = queue
 
         # Public r/w parameters.
@@ -66,20 +77,7 @@ class FileTransport(Transport):
         self.permissions = 0o640
 
     def set_parameter(self, name: str, value) -> Transport:
-        if not name in self.parameters:
-            raise KeyError(name)
-
-        conf = self.parameters[name]
-        if not isinstance(value, conf['allowed_types']):
-            raise ValueError(value)
-
-        value = conf['cast_to'](value)
-        conf_min = conf.get('min')
-        conf_max = conf.get('max')
-        if (conf_min is not None and value < conf_min) or \
-           (conf_max is not None and value > conf_max):
-            raise ValueError(value)
-
+        value = self._validators[name](value)
         with self.lock:
             setattr(self, name, value)
 
@@ -94,20 +92,34 @@ class FileTransport(Transport):
         if self.checker is None:
             raise RuntimeError("start() must be called before calling send_message()")
 
-        content_type = self.content_type
-        extension = mimetypes.guess_extension(content_type)
-        filename = os.path.join(self.path, '%d%s' % (time.time(), extension))
+        # The counter prevents name collisions between messages
+        # sent during the same nanosecond.
+        filename = os.path.join(self.path, '%d_%d%s' % (time.time_ns(), next(self.counter), self.extension))
         with self.lock:
             permissions = self.permissions
             uid = self.uid
             gid = self.gid
+
+        # Serialize the message before creating the file, so that
+        # no empty file is left behind if that fails.
+        # Use a memoryview so that partial writes do not copy
+        # the remaining data around.
+        message.validate()
+        data = memoryview(self.serializer.serialize(message))
+
         fd = os.open(filename, os.O_WRONLY | O_BINARY | O_NONBLOCK | O_EXLOCK | O_CREAT | O_EXCL, permissions)
         try:
             if not O_EXLOCK:
                 fcntl.lockf(fd, fcntl.LOCK_EX)
             try:
                 os.fchown(fd, uid, gid)
-                data = bytes(message.serialize(content_type))
+                # Allocate the space for larger messages in one go,
+                # rather than growing the file block by block.
+                if len(data) > 4096 and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(fd, 0, len(data))
+                    except OSError:
+                        pass # Not supported by this filesystem.
                 while data:
                     try:
                         written = os.write(fd, data)
@@ -121,20 +133,28 @@ class FileTransport(Transport):
             os.close(fd)
 
     def _handle_file(self, content_type, filename):
-        buf = b""
         try:
             # On some systems, the file descriptor must be opened in (read-)write mode
             # so that an exclusive lock can be obtained.
-            fd = os.open(filename, os.O_RDWR | O_BINARY | O_NONBLOCK | O_EXLOCK, 0)
+            try:
+                fd = os.open(filename, os.O_RDWR | O_BINARY | O_NONBLOCK | O_EXLOCK, 0)
+            except FileNotFoundError:
+                # The file was already processed and removed
+                # (e.g. inotify reports our own close() on that file).
+                return
             try:
                 if not O_EXLOCK:
                     fcntl.lockf(fd, fcntl.LOCK_EX)
                 try:
-                    while True:
-                        data = os.read(fd, 1024)
-                        if not data:
-                            break
-                        buf += data
+                    # Read the whole file at once. We ask for one more byte
+                    # than expected so that a short read tells us we reached
+                    # the end of the file without needing another read.
+                    size = os.fstat(fd).st_size + 1
+                    chunks = [os.read(fd, size)]
+                    # The file grew in the meantime: read the rest of it.
+                    while len(chunks[-1]) == size:
+                        chunks.append(os.read(fd, size))
+                    buf = b"".join(chunks)
                 finally:
                     if not O_EXLOCK:
                         fcntl.lockf(fd, fcntl.LOCK_UN)
@@ -146,6 +166,55 @@ class FileTransport(Transport):
         else:
             self.queue.put(Message.unserialize(SerializedMessage(content_type, buf)), timeout=30)
 
+    def _handle_entry(self, file):
+        filename, extension = os.path.splitext(file)
+        try:
+            mime = mimetypes.types_map[extension]
+            get_serializer(mime) # Is this a supported MIME type?
+        except KeyError as e:
+            return
+        self._handle_file(mime, os.path.join(self.path, file))
+
+    def _scan_files(self):
+        for file in os.listdir(self.path):
+            self._handle_entry(file)
+
+    def _poll_files(self):
+        while True:
+            self._scan_files()
+
+            with self.lock:
+                interval = self.interval
+            if self.checker_shutdown.wait(interval):
+                break
+
+    def _watch_files(self, inotify):
+        # Files may have been created before the watch was set up.
+        self._scan_files()
+
+        wakeup = self.checker_wakeup[0]
+        while True:
+            with self.lock:
+                interval = self.interval
+            ready, _, _ = select.select([inotify, wakeup], [], [], interval)
+            if wakeup in ready or self.checker_shutdown.is_set():
+                break
+
+            # Rescan the whole directory from time to time (and whenever
+            # some events were lost) to pick up files that could not be
+            # processed earlier.
+            if inotify not in ready:
+                self._scan_files()
+                continue
+
+            events = inotify.read(timeout=0)
+            if any(event.mask & inotify_flags.Q_OVERFLOW for event in events):
+                self._scan_files()
+                continue
+
+            for event in events:
+                self._handle_entry(event.name)
+
     def _check_files(self):
         if not self.queue:
             return
@@ -155,26 +224,32 @@ class FileTransport(Transport):
         if self.checker_shutdown.wait(interval):
             return
 
-        while True:
-            for file in os.listdir(self.path):
-                filename, extension = os.path.splitext(file)
-                try:
-                    mime = mimetypes.types_map[extension]
-                    get_serializer(mime) # Is this a supported MIME type?
-                except KeyError as e:
-                    continue
-                self._handle_file(mime, os.path.join(self.path, file))
+        # Use inotify when available to get notified of new files,
+        # and fall back to polling the directory otherwise.
+        inotify = None
+        if INotify is not None:
+            try:
+                inotify = INotify()
+                inotify.add_watch(self.path, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+            except OSError:
+                if inotify is not None:
+                    inotify.close()
+                inotify = None
 
-            with self.lock:
-                interval = self.interval
-            if self.checker_shutdown.wait(interval):
-                break
+        if inotify is None:
+            return self._poll_files()
+
+        try:
+            self._watch_files(inotify)
+        finally:
+            inotify.close()
 
     def start(self) -> Transport:
         if self.checker is not None:
             raise RuntimeError()
 
         self.checker_shutdown.clear()
+        self.checker_wakeup = os.pipe()
         self.checker = threading.Thread(target=self._check_files)
         self.checker.start()
 
@@ -183,6 +258,10 @@ class FileTransport(Transport):
             raise RuntimeError()
 
         self.checker_shutdown.set()
+        os.write(self.checker_wakeup[1], b'\0')
         self.checker.join()
         self.checker = None
+        for fd in self.checker_wakeup:
+            os.close(fd)
+        self.checker_wakeup = None
 
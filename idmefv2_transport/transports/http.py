@@ -1,11 +1,14 @@
 # Copyright (C) 2021 CS GROUP - France. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import asyncio
 import email.parser
 import email.policy
+import functools
 import os
 import io
 import requests
+import secrets
 import socket
 import socketserver
 import threading
@@ -14,20 +17,122 @@ import warnings
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from idmefv2 import Message, SerializedMessage, get_serializer
-from queue import Queue
+from queue import Empty, Full, LifoQueue, Queue
+from requests.adapters import HTTPAdapter
 from typing import Optional
 from urllib.parse import urlparse, unquote
+from urllib3.util.retry import Retry
 
 from ..exceptions import InvalidLocationError
-from ..transport import Transport
+from ..transport import Transport, put_many
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+# 640 kB ought to be enough for anybody... :)
+MAX_BODY_SIZE = 655360
+
+# Length of the boundaries used when sending multipart requests.
+BOUNDARY_LENGTH = 32
+
+
+@functools.lru_cache(maxsize=128)
+def _is_supported(content_type: str) -> bool:
+    try:
+        get_serializer(content_type)
+    except KeyError:
+        return False
+    return True
+
+
+def _is_acceptable(content_type: str) -> bool:
+    """
+    Returns whether a request with the given (top-level) content type
+    may contain IDMEFv2 messages, so that other requests can be rejected
+    before their body is even read.
+    """
+    return content_type.startswith('multipart/') or _is_supported(content_type)
+
+
+def _iter_parts(message):
+    if not message.is_multipart():
+        return iter([message])
+    return message.iter_attachments()
+
+
+def _process_request(queue: Queue, headers: bytes, body: bytes) -> HTTPStatus:
+    """
+    Decodes the IDMEFv2 messages contained in an HTTP request
+    and adds them to the given queue.
+
+    @param queue:
+        The queue where the messages will be stored.
+
+    @param headers:
+        The request's headers, in serialized form.
+
+    @param body:
+        The request's body (any bytes-like object).
+
+    Returns the HTTP status code to send back to the client.
+    """
+    # Parse the HTTP data again starting from the headers.
+    # The whole request is available at this point, so parse it in one go.
+    parser = email.parser.BytesParser(policy=email.policy.HTTP)
+    message = parser.parsebytes(headers + body)
+
+    # We iterate over the request's parts twice:
+    # - we try to decode each part to a valid IDMEF message
+    # - then, we add those messages to the queue
+    #
+    # We do that so as to ensure that either all the messages
+    # have been processed, or none of them have. Note that this only holds
+    # for the queue itself when it supports atomic batches (see BatchQueue):
+    # with a plain queue.Queue, some messages may already have been added
+    # when another producer fills the queue up, as explained below.
+    parts = [(part.get_content_type(), part) for part in _iter_parts(message)]
+
+    # Check the content types first, as it is much cheaper than decoding.
+    if not all(_is_supported(content_type) for content_type, part in parts):
+        return HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+    unserialize = Message.unserialize
+    try:
+        messages = [unserialize(SerializedMessage(content_type, part.get_content()))
+                    for content_type, part in parts]
+    except Exception:
+        return HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+    # We expect at least one IDMEF message.
+    if not messages:
+        return HTTPStatus.UNPROCESSABLE_ENTITY
+
+    nb_messages = len(messages)
+    if queue.maxsize > 0 and (queue.maxsize - queue.qsize()) < nb_messages:
+        return HTTPStatus.SERVICE_UNAVAILABLE
+
+    # Add the IDMEF messages to the queue, in the same order
+    # they appeared in the request.
+    #
+    # Another producer may fill the queue up in the meantime,
+    # in which case we wait for some room to become available,
+    # like the other transports do. If none becomes available,
+    # the client is asked to try again later. A BatchQueue leaves
+    # the queue untouched in that case, but a plain queue.Queue
+    # keeps the messages that could be added before, which the
+    # client will then send again.
+    try:
+        put_many(queue, messages, timeout=30)
+    except Full:
+        return HTTPStatus.SERVICE_UNAVAILABLE
+
+    return HTTPStatus.NO_CONTENT
 
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
-    def _iter_parts(self, message):
-        if not message.is_multipart():
-            return iter([message])
-        return message.iter_attachments()
-
     def do_POST(self):
         try:
             self._do_POST()
@@ -47,66 +152,172 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         except ValueError:
             return self.send_error(HTTPStatus.BAD_REQUEST)
 
-        # 640 kB ought to be enough for anybody... :)
-        if length >= 655360:
+        if length >= MAX_BODY_SIZE:
             return self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
 
-        # Parse the HTTP data again starting from the headers.
-        # Since the headers have already been parsed and rfile is non-seektable,
-        # we cannot use email.message_from_binary_file() here.
-        feedparser = email.parser.BytesFeedParser(None, policy=email.policy.HTTP)
-        feedparser.feed(bytes(self.headers))
-        while length > 0:
-            data = self.rfile.read(min(8192, length))
-            if not data:
-                break
-            feedparser.feed(data)
-            length -= len(data)
-        message = feedparser.close()
-
-        # We iterate over the request's parts twice:
-        # - we try to decode each part to a valid IDMEF message
-        # - then, we add those messages to the queue
-        #
-        # We do that so as to ensure that either all the messages
-        # have been processed, or none of them have.
-        messages = []
-        for part in self._iter_parts(message):
-            content_type = part.get_content_type()
+        if not _is_acceptable(self.headers.get_content_type()):
+            return self.send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+        # The body's size is already bounded above, so read it all at once,
+        # reusing one of the server's buffers to limit memory allocations.
+        buffer = self.server.get_buffer(length)
+        try:
+            view = memoryview(buffer)
+            body = view[:self.rfile.readinto(view[:length])]
             try:
-                messages.append(Message.unserialize(SerializedMessage(content_type, part.get_content())))
-            except Exception:
-                return self.send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
-
-        # We expect at least one IDMEF message.
-        if not messages:
-            return self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY)
-
-        # @HACK This code makes use of Queue.queue()'s internal API
-        queue = self.server.message_queue
-        nb_messages = len(messages)
-        with queue.not_full:
-            if queue.maxsize > 0 and (queue.maxsize - queue.qsize()) < nb_messages:
-                return self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
-
-            # Add each IDMEF message to the queue, in the same order
-            # they appeared in the request.
-            #
-            # We use _put() here to enqueue the items to avoid making
-            # any assumption on the queue's implementation.
-            for msg in messages:
-                queue._put(msg)
-            queue.unfinished_tasks += nb_messages
-            queue.not_empty.notify(nb_messages)
-
-        self.send_response(HTTPStatus.NO_CONTENT)
+                status = _process_request(self.server.message_queue,
+                                          bytes(self.headers), body)
+            finally:
+                body.release()
+                view.release()
+        finally:
+            self.server.release_buffer(buffer)
+
+        if status != HTTPStatus.NO_CONTENT:
+            return self.send_error(status)
+
+        self.send_response(status)
         self.end_headers()
 
 
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # Maximum number of request buffers kept around for reuse.
+    max_buffers = 4
+
     def __init__(self, server_address, RequestHandlerClass, queue):
         super().__init__(server_address, RequestHandlerClass)
         self.message_queue = queue
+        self.buffers = LifoQueue(self.max_buffers)
+        self.buffers_lock = threading.Lock()
+        self.nb_buffers = 0
+
+    def get_buffer(self, length: int) -> bytearray:
+        """
+        Returns a buffer large enough to hold a request's body
+        of the given length.
+
+        Pooled buffers are used when available. Otherwise, a buffer
+        matching the request's size is allocated, unless the pool
+        has not been filled up yet.
+        """
+        try:
+            return self.buffers.get_nowait()
+        except Empty:
+            pass
+
+        with self.buffers_lock:
+            if self.nb_buffers < self.max_buffers:
+                self.nb_buffers += 1
+                return bytearray(MAX_BODY_SIZE)
+        return bytearray(length)
+
+    def release_buffer(self, buffer: bytearray) -> None:
+        """
+        Gives a buffer obtained with get_buffer() back to the server.
+        """
+        # Only the pool's buffers are kept.
+        if len(buffer) == MAX_BODY_SIZE:
+            try:
+                self.buffers.put_nowait(buffer)
+            except Full:
+                pass
+
+
+class AsyncHTTPServer:
+    """
+    HTTP server handling all the requests from a single asyncio event loop.
+
+    This class mimics the interface of socketserver.BaseServer
+    so that it can be used as a drop-in replacement for ThreadedHTTPServer.
+    """
+    def __init__(self, server_address, queue):
+        self.message_queue = queue
+        # Set up the socket like socketserver does
+        # (socket.create_server() requires Python 3.8+).
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if os.name == 'posix':
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen()
+        except OSError:
+            self.socket.close()
+            raise
+        self.loop = asyncio.new_event_loop()
+        self.running = threading.Event()
+        self.stopped = threading.Event()
+
+        app = web.Application(client_max_size=MAX_BODY_SIZE)
+        app.router.add_route('POST', '/{path:.*}', self._handle_post)
+        self.runner = web.AppRunner(app)
+        try:
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.SockSite(self.runner, self.socket)
+            self.loop.run_until_complete(site.start())
+        except OSError:
+            self.server_close()
+            raise
+
+    async def _handle_post(self, request):
+        try:
+            if request.path != '/':
+                return web.Response(status=HTTPStatus.FORBIDDEN)
+
+            length = request.content_length
+            if length is None:
+                return web.Response(status=HTTPStatus.LENGTH_REQUIRED)
+
+            if length >= MAX_BODY_SIZE:
+                return web.Response(status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+            if not _is_acceptable(request.content_type):
+                return web.Response(status=HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+            headers = b''.join(b'%s: %s\r\n' % header for header in request.raw_headers) + b'\r\n'
+            body = await request.read()
+            # Decoding the messages and waiting for room in the queue may
+            # take a while: do it outside of the event loop so that other
+            # connections keep being served in the meantime.
+            status = await self.loop.run_in_executor(None, _process_request,
+                                                     self.message_queue, headers, body)
+        except Exception as e:
+            return web.Response(status=HTTPStatus.INTERNAL_SERVER_ERROR, text=str(e))
+        return web.Response(status=status)
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.running.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # The loop's resources are released from the loop's own thread.
+            try:
+                self._cleanup()
+            finally:
+                self.stopped.set()
+
+    def shutdown(self):
+        # Like socketserver's shutdown(), this must be called while
+        # serve_forever() is running (or about to run) in another thread.
+        self.running.wait()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait()
+
+    def server_close(self):
+        # The resources were already released by serve_forever()
+        # if the server ever ran.
+        if not self.running.is_set():
+            self._cleanup()
+
+    def _cleanup(self):
+        try:
+            self.loop.run_until_complete(self.runner.cleanup())
+            # Only available on Python 3.9+.
+            if hasattr(self.loop, 'shutdown_default_executor'):
+                self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        finally:
+            self.loop.close()
+            self.socket.close()
 
 
 class HTTPTransport(Transport):
@@ -119,11 +330,14 @@ class HTTPTransport(Transport):
         'ca_cert': dict(allowed_types=str, cast_to=str),
         'requested_address': dict(allowed_types=(), cast_to=None),
         'server_address': dict(allowed_types=(), cast_to=None),
+        'linger_ms': dict(allowed_types=int, cast_to=int, min=0),
+        # Batches must stay below the size accepted by the receiving side.
+        'batch_bytes': dict(allowed_types=int, cast_to=int, min=0, max=MAX_BODY_SIZE - 1),
     }
 
     def __init__(self, url: str, queue: Optional[Queue] = None, content_type: Optional[str] = None) -> None:
         result = urlparse(url)
-        if result.scheme not in ('http', 'https'):
+        if result.scheme not in ('http', 'https', 'http+sync', 'https+sync'):
             raise InvalidLocationError("Invalid scheme")
 
         if result.hostname is None:
@@ -132,15 +346,34 @@ class HTTPTransport(Transport):
         if content_type:
             self.content_type = content_type
 
-        # Check whether the given content_type is supported.
-        get_serializer(self.content_type)
+        # Check whether the given content_type is supported,
+        # and keep the matching serializer around for later use.
+        self.serializer = get_serializer(self.content_type)
 
         # Private parameters.
         self.lock = threading.Lock()
         self.started = False
         self.server = None
         self.server_thread = None
+        self.session = None
         self.queue = queue
+        self.location = result
+        # The "+sync" schemes select the thread-based HTTP server
+        # rather than the asyncio-based one when receiving messages.
+        self.scheme, _, sync = result.scheme.partition('+')
+        self.sync = bool(sync) or web is None
+        self.target = result._replace(scheme=self.scheme).geturl()
+        self.headers = {'Content-Type': self.content_type}
+        self.batch_lock = threading.Lock()
+        self.batch = []
+        self.batch_size = 0
+        self.batch_timer = None
+        self.batch_timers = []
+        self.part_headers = b'Content-Type: ' + self.content_type.encode('ascii') + b'\r\n\r\n'
+        # Upper bound for the multipart framing added around each message:
+        # "--<boundary>\r\n<headers><payload>\r\n", plus the closing
+        # "--<boundary>--\r\n" delimiter.
+        self.part_overhead = 2 * (BOUNDARY_LENGTH + 6) + len(self.part_headers)
 
         # Public r/w parameters.
         self.interval = 10
@@ -148,26 +381,15 @@ class HTTPTransport(Transport):
         self.my_cert = None
         self.my_key = None
         self.ca_cert = None
+        self.linger_ms = 0
+        self.batch_bytes = 65536
 
         # Public r/o parameters.
         self.url = url
         self.server_address = None
 
     def set_parameter(self, name: str, value) -> Transport:
-        if not name in self.parameters:
-            raise KeyError(name)
-
-        conf = self.parameters[name]
-        if not isinstance(value, conf['allowed_types']):
-            raise ValueError(value)
-
-        value = conf['cast_to'](value)
-        conf_min = conf.get('min')
-        conf_max = conf.get('max')
-        if (conf_min is not None and value < conf_min) or \
-           (conf_max is not None and value > conf_max):
-            raise ValueError(value)
-
+        value = self._validators[name](value)
         with self.lock:
             setattr(self, name, value)
 
@@ -182,42 +404,136 @@ class HTTPTransport(Transport):
         if not self.started:
             raise RuntimeError("start() must be called before calling send_message()")
 
-        headers = {'Content-Type': self.content_type}
+        message.validate()
+        payload = self.serializer.serialize(message)
+
+        linger_ms = self.linger_ms
+        if not linger_ms:
+            response = self.session.post(self.target, data=payload, headers=self.headers)
+            response.raise_for_status()
+            return self
+
+        # Batching mode: the message is sent later on, along with other messages,
+        # once enough data has been accumulated or the linger delay expires.
+        size = len(payload) + self.part_overhead
+        batches = []
+        with self.batch_lock:
+            # Send the pending messages first if adding this one
+            # would make the request too large.
+            if self.batch and self.batch_size + size > self.batch_bytes:
+                batches.append(self._take_batch())
+
+            self.batch.append(payload)
+            self.batch_size += size
+            if self.batch_size >= self.batch_bytes:
+                batches.append(self._take_batch())
+            elif self.batch_timer is None:
+                self.batch_timer = threading.Timer(linger_ms / 1000., self._flush_batch)
+                self.batch_timer.daemon = True
+                self.batch_timer.start()
+                # Keep track of the timers so that stop() can wait
+                # for the batches they may still be sending.
+                self.batch_timers = [timer for timer in self.batch_timers if timer.is_alive()]
+                self.batch_timers.append(self.batch_timer)
+
+        for batch in batches:
+            self._post_batch(batch)
+        return self
+
+    def flush(self) -> Transport:
+        """
+        Sends the messages waiting to be sent as part of a batch right away.
+
+        This is only useful when the "linger_ms" parameter has been set.
+        """
+        if not self.started:
+            raise RuntimeError("start() must be called before calling flush()")
+
+        with self.batch_lock:
+            batch = self._take_batch()
+        if batch:
+            self._post_batch(batch)
+        return self
+
+    def _take_batch(self):
+        # Must be called with the batch lock held.
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        batch = self.batch
+        self.batch = []
+        self.batch_size = 0
+        return batch
+
+    def _flush_batch(self):
+        with self.batch_lock:
+            batch = self._take_batch()
+        if batch:
+            try:
+                self._post_batch(batch)
+            except Exception as e:
+                warnings.warn(str(e), RuntimeWarning)
+
+    @staticmethod
+    def _make_boundary() -> bytes:
+        return secrets.token_hex(BOUNDARY_LENGTH // 2).encode('ascii')
+
+    def _post_batch(self, batch):
+        if len(batch) == 1:
+            response = self.session.post(self.target, data=batch[0], headers=self.headers)
+            response.raise_for_status()
+            return
+
+        # Send all the messages as part of a single multipart request.
+        boundary = self._make_boundary()
+        part_headers = self.part_headers
+        body = []
+        for payload in batch:
+            body += [b'--', boundary, b'\r\n', part_headers, payload, b'\r\n']
+        body += [b'--', boundary, b'--\r\n']
+        headers = {'Content-Type': 'multipart/mixed; boundary="%s"' % boundary.decode('ascii')}
+        response = self.session.post(self.target, data=b''.join(body), headers=headers)
+        response.raise_for_status()
+
+    def start(self) -> Transport:
+        if self.started:
+            raise RuntimeError()
+
         with self.lock:
             my_cert = self.my_cert
             my_key = self.my_key
             ca_cert = self.ca_cert
 
-        params = {}
+        # Reuse the same connection(s) for every message sent
+        # rather than going through a new TCP/TLS handshake each time.
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10,
+                              max_retries=Retry(total=3, read=False, backoff_factor=0.5))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         if ca_cert:
-            params['verify'] = ca_cert
+            session.verify = ca_cert
         if my_cert:
             if my_key:
-                params['cert'] = (my_cert, my_key)
+                session.cert = (my_cert, my_key)
             else:
-                params['cert'] = my_cert
-
-        response = requests.post(self.url, data=bytes(message.serialize(self.content_type)),
-                                 headers=headers, **params)
-        response.raise_for_status()
-        return self
-
-    def start(self) -> Transport:
-        if self.started:
-            raise RuntimeError()
+                session.cert = my_cert
 
         if self.queue:
             # We already parsed the URL once during init, and we already checked
             # that it contains a supported scheme and a seemingly valid hostname.
-            result = urlparse(self.url)
+            result = self.location
             port = result.port
             if port is None:
-                port = socket.getservbyname(result.scheme, 'tcp')
+                port = socket.getservbyname(self.scheme, 'tcp')
 
             # @FIXME Add support for HTTPS
-            self.server = ThreadedHTTPServer((result.hostname, port),
-                                             HTTPRequestHandler,
-                                             self.queue)
+            if self.sync:
+                self.server = ThreadedHTTPServer((result.hostname, port),
+                                                 HTTPRequestHandler,
+                                                 self.queue)
+            else:
+                self.server = AsyncHTTPServer((result.hostname, port), self.queue)
 
             try:
                 with self.lock:
@@ -225,16 +541,30 @@ class HTTPTransport(Transport):
                     self.server_thread = threading.Thread(target=self.server.serve_forever)
                     self.server_thread.start()
             except:
-                self.server.shutdown()
+                # The server thread never started,
+                # so there is nothing to shut down.
+                self.server.server_close()
                 self.server = None
+                session.close()
                 raise
 
+        self.session = session
         self.started = True
 
     def stop(self) -> Transport:
         if not self.started:
             raise RuntimeError()
 
+        # Wait for the batches being sent in the background,
+        # then send any message still waiting to be part of a batch.
+        with self.batch_lock:
+            timers = self.batch_timers
+            self.batch_timers = []
+        for timer in timers:
+            timer.cancel()
+            timer.join()
+        self._flush_batch()
+
         if self.server:
             with self.lock:
                 self.server_address = None
@@ -244,5 +574,7 @@ class HTTPTransport(Transport):
             self.server_thread.join()
             self.server_thread = None
 
+        self.session.close()
+        self.session = None
         self.started = False
 
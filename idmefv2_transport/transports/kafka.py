@@ -15,7 +15,11 @@ from typing import Optional
 from urllib.parse import urlparse
 
 from ..exceptions import InvalidLocationError
-from ..transport import Transport
+from ..transport import Transport, put_many
+
+# Maximum delay (in seconds) before the consumer notices that
+# the transport is being stopped.
+SHUTDOWN_CHECK_INTERVAL = 0.5
 
 
 class KafkaTransport(Transport):
@@ -28,12 +32,18 @@ class KafkaTransport(Transport):
         'client_id': dict(allowed_types=str, cast_to=str),
         'consumer_topics': dict(allowed_types=str, cast_to=str),
         'producer_topic': dict(allowed_types=str, cast_to=str),
+        # No longer used: the consumer polls every SHUTDOWN_CHECK_INTERVAL
+        # seconds so that stop() remains prompt. Kept for compatibility.
         'interval': dict(allowed_types=(int, float), cast_to=float, min=1.),
+        'linger_ms': dict(allowed_types=int, cast_to=int, min=0),
+        'batch_size': dict(allowed_types=int, cast_to=int, min=0),
+        'compression_type': dict(allowed_types=str, cast_to=str),
+        'acks': dict(allowed_types=int, cast_to=int, min=-1, max=1),
     }
 
     def __init__(self, url: str, queue: Optional[Queue] = None, content_type: Optional[str] = None) -> None:
         result = urlparse(url)
-        if result.scheme not in ('kafka'):
+        if result.scheme != 'kafka':
             raise InvalidLocationError("Invalid scheme")
 
         if result.netloc is None:
@@ -42,8 +52,9 @@ class KafkaTransport(Transport):
         if content_type:
             self.content_type = content_type
 
-        # Check whether the given content_type is supported.
-        get_serializer(self.content_type)
+        # Check whether the given content_type is supported,
+        # and keep the matching serializer around for later use.
+        self.serializer = get_serializer(self.content_type)
 
         # Private parameters.
         self.lock = threading.Lock()
@@ -63,22 +74,13 @@ class KafkaTransport(Transport):
         self.client_id = None
         self.consumer_topics = 'idmefv2'
         self.producer_topic = 'idmefv2'
+        self.linger_ms = 50
+        self.batch_size = 65536
+        self.compression_type = None
+        self.acks = 1
 
     def set_parameter(self, name: str, value) -> Transport:
-        if not name in self.parameters:
-            raise KeyError(name)
-
-        conf = self.parameters[name]
-        if not isinstance(value, conf['allowed_types']):
-            raise ValueError(value)
-
-        value = conf['cast_to'](value)
-        conf_min = conf.get('min')
-        conf_max = conf.get('max')
-        if (conf_min is not None and value < conf_min) or \
-           (conf_max is not None and value > conf_max):
-            raise ValueError(value)
-
+        value = self._validators[name](value)
         with self.lock:
             setattr(self, name, value)
 
@@ -93,27 +95,61 @@ class KafkaTransport(Transport):
         if not self.started:
             raise RuntimeError("start() must be called before calling send_message()")
 
-        if not self.producer:
+        # The producer is thread-safe and each attribute read below is atomic,
+        # so there is no need to hold the lock while sending the message.
+        producer = self.producer
+        if not producer:
             raise RuntimeError("This transport cannot be used to send messages")
 
         headers = [('Content-Type', self.content_type.encode('ascii'))]
-        with self.lock:
-            self.producer.send(self.producer_topic, bytes(message.serialize(self.content_type)),
-                               headers=headers)
-        # @FIXME Make the delay customisable?
-        self.producer.flush(60.)
+        message.validate()
+        producer.send(self.producer_topic, self.serializer.serialize(message),
+                      headers=headers)
         return self
 
-    def _consume(self, interval, topics, params):
+    def flush(self, timeout: Optional[float] = 60.) -> Transport:
+        """
+        Blocks until all the messages sent so far have been delivered
+        to the Kafka brokers (or the timeout expires).
+
+        @param timeout:
+            Maximum number of seconds to wait for, or None to wait forever.
+        """
+        if not self.started:
+            raise RuntimeError("start() must be called before calling flush()")
+
+        if self.producer:
+            self.producer.flush(timeout)
+        return self
+
+    def _consume(self, topics, params):
+        # KafkaConsumer.poll() expects a timeout in milliseconds and cannot
+        # be interrupted from another thread, so we wait in short slices
+        # to notice the shutdown request promptly.
+        timeout_ms = int(SHUTDOWN_CHECK_INTERVAL * 1000)
         consumer = KafkaConsumer(*topics, **params)
         while not self.shutdown.is_set():
-            for topic, data in consumer.poll(interval).items():
+            # Decode everything returned by this poll first,
+            # then hand the messages over to the queue in one go.
+            batch = []
+            for data in consumer.poll(timeout_ms).values():
                 for msg in data:
                     content_type = [h[1] for h in msg.headers if h[0].lower() == 'content-type']
                     if len(content_type) != 1:
                         continue
-                    content_type = content_type[0].decode('ascii')
-                    self.queue.put(Message.unserialize(SerializedMessage(content_type, msg.value)), timeout=30)
+                    try:
+                        content_type = content_type[0].decode('ascii')
+                        batch.append(Message.unserialize(SerializedMessage(content_type, msg.value)))
+                    except Exception as e:
+                        # Skip this record, but keep the rest of the batch.
+                        warnings.warn(str(e), RuntimeWarning)
+
+            # Batches are added atomically to a BatchQueue, so they must
+            # not be larger than the queue itself.
+            if batch:
+                step = self.queue.maxsize if self.queue.maxsize > 0 else len(batch)
+                for i in range(0, len(batch), step):
+                    put_many(self.queue, batch[i:i + step], timeout=30)
         consumer.close()
 
     def start(self) -> Transport:
@@ -121,7 +157,6 @@ class KafkaTransport(Transport):
             raise RuntimeError()
 
         with self.lock:
-            interval = self.interval
             params = {
                 'bootstrap_servers': self.bootstrap.split(','),
                 'group_id': self.group_id,
@@ -130,14 +165,24 @@ class KafkaTransport(Transport):
                 'ssl_certfile': self.my_cert,
                 'ssl_keyfile': self.my_key,
             }
+            # Only used by producers
+            producer_params = {
+                'linger_ms': self.linger_ms,
+                'batch_size': self.batch_size,
+                'compression_type': self.compression_type,
+                'acks': self.acks,
+            }
 
         if self.queue and self.consumer_topics:
             self.shutdown.clear()
             self.consumer = threading.Thread(target=self._consume,
-                                             args=(interval, self.consumer_topics.split(','), params))
+                                             args=(self.consumer_topics.split(','), params))
             self.consumer.start()
 
         if self.producer_topic:
+            # The consumer thread may still be using "params",
+            # so we work on a copy here.
+            params = dict(params, **producer_params)
             params.pop('group_id') # Only used by consumers
             self.producer = KafkaProducer(**params)
 
@@ -156,6 +201,8 @@ class KafkaTransport(Transport):
         self.shutdown.set()
 
         if self.producer:
+            # Deliver any message still waiting in the producer's buffers.
+            self.producer.flush(60.)
             self.producer.close()
             self.producer = None
 
@@ -28,16 +28,22 @@ setup(
     ],
     install_requires=[
         "idmefv2",
+        "importlib_metadata; python_version < '3.8'",
         "kafka-python",
         "requests",
-        "setuptools",
     ],
+    extras_require={
+        'aiohttp': ["aiohttp"],
+        'inotify': ["inotify_simple"],
+    },
     packages=find_packages("."),
     entry_points={
         'idmefv2.transport': [
             'file = idmefv2_transport.transports.file:FileTransport',
             'http = idmefv2_transport.transports.http:HTTPTransport',
             'https = idmefv2_transport.transports.http:HTTPTransport',
+            'http+sync = idmefv2_transport.transports.http:HTTPTransport',
+            'https+sync = idmefv2_transport.transports.http:HTTPTransport',
             'kafka = idmefv2_transport.transports.kafka:KafkaTransport',
         ],
     },